@@ -1,8 +1,23 @@
 import nox
 
 
-# An example nox task definition that runs on many supported Python versions:
-@nox.session(python=["3.7", "3.8", "3.9", "3.10"])
+@nox.session(python=["3.9", "3.10", "3.11", "3.12"], reuse_venv=True)
 def test(session):
-    session.run("pytest", "--cov=onionizer", "--cov-report=html")
-    session.run("mutmut", "run")
+    session.install(
+        "-e", ".[jit]", "pytest", "pytest-asyncio", "pytest-cov", "pytest-xdist", "cython"
+    )
+    # both drivers of sync onions are covered: the compiled one, then the pure python one
+    session.run("cythonize", "-q", "-i", "onionizer/onionizer/_fast.pyx")
+    session.run("pytest", "-n", "auto", "--cov=onionizer", "--cov-report=")
+    session.run(
+        "pytest", "-n", "auto", "--cov=onionizer", "--cov-append", "--cov-report=html",
+        env={"ONIONIZER_PURE_PYTHON": "1"},
+    )
+
+
+# mutation testing dominates the wall-clock time, run it on a single interpreter
+@nox.session(python="3.12", reuse_venv=True)
+def mutation(session):
+    session.install("-e", ".", "pytest", "pytest-asyncio", "mutmut==2.4.3")
+    # the built extension would run generator-only onions and mask the mutants of the generated code
+    session.run("mutmut", "run", env={"ONIONIZER_PURE_PYTHON": "1"})
@@ -0,0 +1,104 @@
+# cython: language_level=3
+"""
+Optional compiled driver for sync onions without context managers.
+
+Build it in place with ``cythonize -i onionizer/onionizer/_fast.pyx``.
+When this extension is absent, or when the ONIONIZER_PURE_PYTHON environment
+variable is set, onionizer uses its pure python driver.
+"""
+from collections.abc import Generator
+from types import GeneratorType
+
+from cpython.ref cimport PyObject, Py_XDECREF
+
+from .onionizer import HARD_BYPASS, BYPASS, _refine
+
+cdef extern from *:
+    """
+    /* 1 when the coroutine yielded, 0 when it returned, -1 on error.
+       The value is stored in *result as a new reference. */
+    static int onion_send(PyObject *coroutine, PyObject *value, PyObject **result) {
+    #if PY_VERSION_HEX >= 0x030A0000
+        return (int)PyIter_Send(coroutine, value, result);
+    #else
+        *result = PyObject_CallMethod(coroutine, "send", "O", value);
+        if (*result != NULL) {
+            return 1;
+        }
+        if (PyErr_ExceptionMatches(PyExc_StopIteration)
+                && _PyGen_FetchStopIterationValue(result) == 0) {
+            return 0;
+        }
+        return -1;
+    #endif
+    }
+    """
+    int onion_send(PyObject *coroutine, PyObject *value, PyObject **result) except -1
+
+
+# same values as the layer kinds in onionizer.py
+cdef enum:
+    GENERATOR_FN = 1
+    PREPROCESSOR = 2
+    POSTPROCESSOR = 3
+
+
+cdef inline tuple _capture_message(object coroutine, object value_to_send):
+    # returns the value yielded or returned by the coroutine, and whether it ended,
+    # without raising and catching StopIteration
+    cdef PyObject *result = NULL
+    cdef int status = onion_send(<PyObject *>coroutine, <PyObject *>value_to_send, &result)
+    value = <object>result
+    Py_XDECREF(result)
+    return value, status == 0
+
+
+cdef object _leave_the_onion(list entered, object output):
+    cdef Py_ssize_t i
+    cdef int kind
+    for i in range(len(entered) - 1, -1, -1):
+        kind, layer = entered[i]
+        if kind == POSTPROCESSOR:
+            output = layer(output)
+            continue
+        raw, ended = _capture_message(layer, output)
+        if not ended:
+            raise RuntimeError(
+                "Generator did not exhaust. Your function should yield exactly once."
+            )
+        output = raw
+    return output
+
+
+def run_sync(object func, tuple classified, object args, object kwargs):
+    cdef list entered = []
+    cdef object middleware, coroutine, raw
+    cdef bint ended
+    cdef int kind
+    for kind, middleware in classified:
+        if kind == POSTPROCESSOR:
+            entered.append((kind, middleware._onionizer_func))
+            continue
+        if kind == PREPROCESSOR:
+            raw = middleware._onionizer_func(*args, **kwargs)
+            ended = False
+        else:
+            coroutine = middleware(*args, **kwargs)
+            if type(coroutine) is not GeneratorType and not isinstance(coroutine, Generator):
+                raise TypeError(
+                    f"Middleware {middleware} is not a coroutine. "
+                    f"Did you forget to use a yield statement?"
+                )
+            raw, ended = _capture_message(coroutine, None)
+        if type(raw) is HARD_BYPASS:
+            return raw.value
+        if type(raw) is BYPASS:
+            return _leave_the_onion(entered, raw.value)
+        if ended:
+            return _leave_the_onion(entered, raw)
+        if raw is not None:
+            args, kwargs = _refine(raw, args, kwargs)
+        if kind == GENERATOR_FN:
+            entered.append((kind, coroutine))
+    # just reached the core of the onion
+    return _leave_the_onion(entered, func(*args, **kwargs))
@@ -1,10 +1,12 @@
 import asyncio
 import functools
 import inspect
+import os
+import types
 import typing
+import weakref
 from abc import ABC
 from contextlib import ExitStack
-from dataclasses import dataclass
 from typing import Callable, Any, Iterable, Sequence, TypeVar, Generator, Mapping
 
 T = TypeVar("T")  # pragma: no mutate
@@ -29,6 +31,8 @@ class HARD_BYPASS:
     This is a special value that can be returned by a middleware to totally bypass the onion.
     If a middleware returns this value, no other middleware will be called.
     """
+    __slots__ = ("value",)
+
     def __init__(self, value):
         self.value = value
 
@@ -37,55 +41,54 @@ class BYPASS:
     This is a special value that can be returned by a middleware to bypass the wrapped function.
     other middleware will be called.
     """
+    __slots__ = ("value",)
+
     def __init__(self, value):
         self.value = value
 
-def _capture_last_message(coroutine, value_to_send: Any) -> Any:
-    middleware_output = _capture_message(coroutine, value_to_send)
-    if middleware_output.status != "stop":
-        raise RuntimeError(
-            "Generator did not exhaust. Your function should yield exactly once."
-        )
-    return middleware_output.value
-
-# dataclass representing middleware output
-@dataclass
-class MiddlewareOutput:
-    value: Any
-    coroutine_ended: bool
-
-    @property
-    def status(self):
-        if isinstance(self.value, HARD_BYPASS):
-            return 'hard_stop'
-        if isinstance(self.value, BYPASS) or self.coroutine_ended:
-            return 'stop'
-
-    @property
-    def output(self):
-        if isinstance(self.value, (HARD_BYPASS, BYPASS)):
-            return self.value.value
-        else:
-            return self.value
 
-def get_middleware_output(coroutine):
-    middleware_output = _capture_message(coroutine, None)
-    return middleware_output
+def _unwrap_bypass(value: Any) -> Any:
+    if type(value) is HARD_BYPASS or type(value) is BYPASS:
+        return value.value
+    return value
 
 
-def _leave_the_onion(coroutines: Sequence, output: Any) -> Any:
-    for coroutine in reversed(coroutines):
-        # reversed to respect onion model
-        output = _capture_last_message(coroutine, output)
-    return output
+# kinds of layers, resolved once at wrap time
+_CTX_MANAGER = 0  # pragma: no mutate
+_GENERATOR_FN = 1  # pragma: no mutate
+# generator functions made by preprocessor/postprocessor,
+# the generated onions call the function they wrap directly
+_PREPROCESSOR = 2  # pragma: no mutate
+_POSTPROCESSOR = 3  # pragma: no mutate
+# neither callable nor a context manager, reported when the onion is called
+_INVALID = 4  # pragma: no mutate
+
+
+def _classify(middleware) -> int:
+    if hasattr(middleware, "__enter__") and hasattr(middleware, "__exit__"):
+        return _CTX_MANAGER
+    # told apart by their code, functools.wraps copies the attributes of a processor
+    # (_onionizer_func included) onto any decorator stacked on top of it, not its code
+    code = getattr(middleware, "__code__", None)
+    if code is _PREPROCESSOR_CODE:
+        return _PREPROCESSOR
+    if code is _POSTPROCESSOR_CODE:
+        return _POSTPROCESSOR
+    if not callable(middleware):
+        return _INVALID
+    return _GENERATOR_FN
 
 
 def as_decorator(middleware):
-    return decorate([middleware])
+    def decorator(func):
+        return wrap(func, (middleware,))
+
+    return decorator
 
 
 def decorate(layers):
-    if not isinstance(layers, Iterable):
+    # concrete types first, the Iterable ABC check goes through __subclasshook__
+    if not isinstance(layers, (tuple, list)) and not isinstance(layers, Iterable):
         if callable(layers):
             layers = [layers]
         else:
@@ -99,44 +102,53 @@ def decorate(layers):
     return decorator
 
 
-async def _capture_async_message(coroutine, value_to_send: Any) -> Any:
-    if hasattr(coroutine, "__next__"):
-        return _capture_message(coroutine, value_to_send)
-    elif hasattr(coroutine, "__anext__"):
-        try:
-            val = await coroutine.asend(value_to_send)
-            return MiddlewareOutput(val, coroutine_ended=False)
-        except StopAsyncIteration as e:
-            # expected if the generator is exhausted
-            return MiddlewareOutput(e.value, coroutine_ended=True)
-    else:
-        raise TypeError(
-            f"Middleware {coroutine} is not a coroutine. "
-            f"Did you forget to use a yield statement?"
-        )
-def _capture_message(coroutine, value_to_send: Any) -> MiddlewareOutput:
-    if not hasattr(coroutine, "__next__"):
-        raise TypeError(
-            f"Middleware {coroutine} is not a coroutine. "
-            f"Did you forget to use a yield statement?"
-        )
+async def _capture_async_message(
+    coroutine, value_to_send: Any
+) -> typing.Tuple[Any, bool]:
+    try:
+        return await coroutine.asend(value_to_send), False
+    except StopAsyncIteration:
+        # expected if the generator is exhausted, async generators cannot return a value
+        return None, True
+
+
+def _is_async_generator(coroutine) -> typing.Optional[bool]:
+    # None means that the middleware did not give back a generator at all
+    # exact types first, the isinstance checks below go through the ABC machinery
+    if type(coroutine) is types.GeneratorType:  # noqa: E721
+        return False
+    if type(coroutine) is types.AsyncGeneratorType:  # noqa: E721
+        return True
+    if isinstance(coroutine, typing.Generator):
+        return False
+    if isinstance(coroutine, typing.AsyncGenerator):
+        return True
+    return None
+
+
+def _is_async_generator_function(middleware) -> typing.Optional[bool]:
+    # decided once at wrap time,
+    # None means that it is only known from what the middleware returns
+    if inspect.isasyncgenfunction(middleware):
+        return True
+    if inspect.isgeneratorfunction(middleware):
+        return False
+    return None
+
+
+def _capture_message(coroutine, value_to_send: Any) -> typing.Tuple[Any, bool]:
+    # returns the value yielded or returned by the coroutine, and whether it ended
     try:
-        val = coroutine.send(value_to_send)
-        return MiddlewareOutput(val, coroutine_ended=False)
+        return coroutine.send(value_to_send), False
     except StopIteration as e:
         # expected if the generator is exhausted
-        return MiddlewareOutput(e.value, coroutine_ended=True)
-
-
-async def async_get_middleware_output(coroutine):
-    output = _capture_async_message(coroutine, None)
-    if inspect.isawaitable(output):
-        output = await output
-    return output
+        return e.value, True
 
 
 def wrap(
-    func: Callable[..., Any], layers: typing.Union[Sequence, Callable[..., Any]]
+    func: Callable[..., Any],
+    layers: Iterable[Any],
+    jit: bool = False,
 ) -> Callable[..., Any]:
     """
     It takes a function and a list of middleware,
@@ -164,98 +176,477 @@ def wrap(
     :type func: Callable[..., Any]
     :param layers: a list of functions that will be called in order
     :type layers: list
-    :return: A function that wraps the original function with the middleware list
+    :param jit: compose preprocessors and postprocessors into a single function,
+        compiled with numba when it is installed and func and every processed function
+        are already jitted
+    :type jit: bool
+    :return: A function that wraps the original function with the middleware list,
+        the same one while it is alive if func is wrapped again with the same layers,
+        or func itself when there is no layer
     """
     _check_validity(func, layers)
+    layers = tuple(layers)
+    if not layers:
+        # nothing to wrap func with, e.g. when every layer is disabled by configuration
+        return func
+    # a cached onion holds func and its layers (see below),
+    # so their ids cannot be reused while it is alive
+    key = (id(func), tuple(map(id, layers)), jit)
+    wrapped_func = _WRAP_CACHE.get(key)
+    if wrapped_func is not None:
+        return wrapped_func
+    # layers are fixed from now on, so classify them once instead of on every call
+    classified = tuple((_classify(middleware), middleware) for middleware in layers)
+    if jit:
+        wrapped_func = _jit_onion(func, classified)
+    elif any(kind == _INVALID for kind, _ in classified):
+        wrapped_func = _invalid_onion(
+            func,
+            next(middleware for kind, middleware in classified if kind == _INVALID),
+        )
+    elif not asyncio.iscoroutinefunction(func):
+        wrapped_func = _sync_onion(func, classified)
+    else:
+        wrapped_func = _async_onion(func, classified)
+    # not on the per-call path,
+    # so the full metadata is copied, annotations and attributes included
+    functools.update_wrapper(wrapped_func, func)
+    # the drivers may only keep what they call, e.g. the function of a preprocessor,
+    # the layers themselves are kept alive for the ids of the cache key
+    wrapped_func._onionizer_layers = layers
+    _WRAP_CACHE[key] = wrapped_func
+    return wrapped_func
+
+
+# onions built by wrap, until nothing refers to them anymore
+_WRAP_CACHE: "weakref.WeakValueDictionary[tuple, Callable[..., Any]]" = (
+    weakref.WeakValueDictionary()
+)
+
+
+# python refuses to compile more than 20 statically nested blocks
+_MAX_NESTED_CONTEXT_MANAGERS = 16  # pragma: no mutate
+
+
+def _sync_onion(func, classified):
+    # module globals bound once so that the closures below avoid global lookups
+    _Generator = typing.Generator
+    _GeneratorType = types.GeneratorType
+    _HARD_BYPASS = HARD_BYPASS
+    _BYPASS = BYPASS
+    _capture = _capture_message
+    _refine_ = _refine
+
+    context_managers_count = sum(kind == _CTX_MANAGER for kind, _ in classified)
+    if context_managers_count == 0 and _run_sync is not None:
+        run_sync = _run_sync
+
+        # a plain function in front of the compiled driver, so that onions are
+        # the same kind of object whether the extension is built or not
+        def wrapped_func(*args, **kwargs):
+            return run_sync(func, classified, args, kwargs)
 
-    if not asyncio.iscoroutinefunction(func):
+        return wrapped_func
+
+    if context_managers_count <= _MAX_NESTED_CONTEXT_MANAGERS:
+        return _generate_sync_onion(func, classified)
+
+    # too many context managers to nest them in generated code
+    if context_managers_count == len(classified):
+        # nothing to go back through, so no list of coroutines either
+        context_managers = tuple(middleware for _, middleware in classified)
 
-        @functools.wraps(func)  # pragma: no mutate
         def wrapped_func(*args, **kwargs):
-            arguments = MixedArgs(args, kwargs)
-            coroutines = []
-            a_middleware_exited_with_result = False
             with ExitStack() as stack:
-                # programmatic support for context manager, possibly nested !
-                # https://docs.python.org/3/library/contextlib.html#contextlib.ExitStack
-                for middleware in layers:
-                    if hasattr(middleware, "__enter__") and hasattr(middleware, "__exit__"):
-                        stack.enter_context(middleware)
-                        continue
-                    coroutine = arguments.call_function(middleware)
-                    if not isinstance(coroutine, typing.Generator):
-
-                        raise TypeError(
-                            f"Middleware {middleware} is not a coroutine. "
-                            f"Did you forget to use a yield statement?"
-                        )
-                    middleware_output = get_middleware_output(coroutine)
-                    if middleware_output.status == "hard_stop":
-                        return middleware_output.output
-                    if middleware_output.status == "stop":
-                        a_middleware_exited_with_result = True
-                        break
-                    arguments = _refine(middleware_output.output, arguments)
-                    coroutines.append(coroutine)
+                for context_manager in context_managers:
+                    stack.enter_context(context_manager)
+                return func(*args, **kwargs)
+
+        return wrapped_func
+
+    def wrapped_func(*args, **kwargs):
+        coroutines = []
+        with ExitStack() as stack:
+            # programmatic support for context manager, possibly nested !
+            # https://docs.python.org/3/library/contextlib.html#contextlib.ExitStack
+            for kind, middleware in classified:
+                if kind == _CTX_MANAGER:
+                    stack.enter_context(middleware)
+                    continue
+                coroutine = middleware(*args, **kwargs)
+                if type(coroutine) is not _GeneratorType and not isinstance(
+                    coroutine, _Generator
+                ):
+
+                    raise TypeError(
+                        f"Middleware {middleware} is not a coroutine. "
+                        f"Did you forget to use a yield statement?"
+                    )
+                raw, ended = _capture(coroutine, None)
+                if type(raw) is _HARD_BYPASS:
+                    return raw.value
+                if type(raw) is _BYPASS:
+                    output = raw.value
+                    break
+                if ended:
+                    output = raw
+                    break
+                if raw is not None:
+                    args, kwargs = _refine_(raw, args, kwargs)
+                coroutines.append(coroutine)
+            else:
                 # just reached the core of the onion
-                if a_middleware_exited_with_result is False:
-                    output = arguments.call_function(func)
+                output = func(*args, **kwargs)
+            # now we go back to the surface
+            while coroutines:
+                # popped in reverse order to respect onion model
+                try:
+                    coroutines.pop().send(output)
+                except StopIteration as e:
+                    output = e.value
                 else:
-                    output = middleware_output.output
-                # now we go back to the surface
-                output = _leave_the_onion(coroutines, output)
-                return output
+                    raise RuntimeError(
+                        "Generator did not exhaust. "
+                        "Your function should yield exactly once."
+                    )
+            return output
+
+    return wrapped_func
+
+
+def _generate_sync_onion(func, classified: tuple):
+    # partial evaluation of the onion: the loop over the layers is unrolled into
+    # straight-line code, compiled once per shape of onion
+    namespace = {
+        "func": func,
+        "_Generator": typing.Generator,
+        "_GeneratorType": types.GeneratorType,
+        "_HARD_BYPASS": HARD_BYPASS,
+        "_BYPASS": BYPASS,
+        "_refine": _refine,
+        "_leave": _leave_the_onion,
+        "_not_a_coroutine": _not_a_coroutine,
+        "_not_exhausted": _not_exhausted,
+    }
+    for i, (kind, middleware) in enumerate(classified):
+        if kind == _CTX_MANAGER:
+            namespace[f"context_manager{i}"] = middleware
+        elif kind == _PREPROCESSOR:
+            namespace[f"preprocessor{i}"] = middleware._onionizer_func
+        elif kind == _POSTPROCESSOR:
+            namespace[f"postprocessor{i}"] = middleware._onionizer_func
+        else:
+            namespace[f"middleware{i}"] = middleware
+    code = _sync_onion_code(tuple(kind for kind, _ in classified))
+    exec(code, namespace)  # pragma: no mutate
+    # popped so that the function does not keep itself alive through its own globals
+    return namespace.pop("wrapped_func")
+
+
+@functools.lru_cache(maxsize=256)  # pragma: no mutate
+def _sync_onion_code(kinds: tuple):
+    # the generated code only depends on the kinds of the layers,
+    # the layers themselves are looked up in the namespace it is executed in.
+    # Context managers become nested with blocks holding the rest of the onion,
+    # so that they exit after every other layer, as with an ExitStack.
+    lines = ["def wrapped_func(*args, **kwargs):"]
+    pad = "    "
+    # layers to go back through on an early return, innermost first
+    entered = ""
+    for i, kind in enumerate(kinds):
+        if kind == _CTX_MANAGER:
+            lines.append(f"{pad}with context_manager{i}:")
+            pad += "    "
+            continue
+        if kind == _PREPROCESSOR:
+            lines.append(f"{pad}raw = preprocessor{i}(*args, **kwargs)")
+        elif kind == _POSTPROCESSOR:
+            entered = f"(postprocessor{i}, True), " + entered
+            continue
+        else:
+            lines += [
+                f"{pad}coroutine{i} = middleware{i}(*args, **kwargs)",
+                f"{pad}if type(coroutine{i}) is not _GeneratorType"
+                f" and not isinstance(coroutine{i}, _Generator):",
+                f"{pad}    raise _not_a_coroutine(middleware{i})",
+                f"{pad}try:",
+                f"{pad}    raw = coroutine{i}.send(None)",
+                f"{pad}except StopIteration as e:",
+                f"{pad}    raw = e.value",
+                f"{pad}    if type(raw) is _BYPASS:",
+                f"{pad}        raw = raw.value",
+                f"{pad}    elif type(raw) is _HARD_BYPASS:",
+                f"{pad}        return raw.value",
+                f"{pad}    return _leave(({entered}), raw)",
+            ]
+        lines += [
+            f"{pad}if type(raw) is _HARD_BYPASS:",
+            f"{pad}    return raw.value",
+            f"{pad}if type(raw) is _BYPASS:",
+            f"{pad}    return _leave(({entered}), raw.value)",
+            f"{pad}if raw is not None:",
+            # the usual tuple and dict yields are refined inline
+            f"{pad}    if type(raw) is tuple:",
+            f"{pad}        args, kwargs = raw, {{}}",
+            f"{pad}    elif type(raw) is dict:",
+            f"{pad}        args, kwargs = (), raw",
+            f"{pad}    else:",
+            f"{pad}        args, kwargs = _refine(raw, args, kwargs)",
+        ]
+        if kind == _GENERATOR_FN:
+            entered = f"(coroutine{i}, False), " + entered
+    # just reached the core of the onion
+    lines.append(f"{pad}output = func(*args, **kwargs)")
+    # now we go back to the surface
+    for i, kind in reversed(list(enumerate(kinds))):
+        if kind == _POSTPROCESSOR:
+            lines.append(f"{pad}output = postprocessor{i}(output)")
+        elif kind == _GENERATOR_FN:
+            lines += [
+                f"{pad}try:",
+                f"{pad}    coroutine{i}.send(output)",
+                f"{pad}except StopIteration as e:",
+                f"{pad}    output = e.value",
+                f"{pad}else:",
+                f"{pad}    raise _not_exhausted()",
+            ]
+    lines.append(f"{pad}return output")
+    return compile("\n".join(lines), "<onionizer>", "exec")  # pragma: no mutate
+
+
+def _jit_onion(func, classified: tuple):
+    # only pure transforms can be composed: no generator to drive, no context to enter
+    if asyncio.iscoroutinefunction(func) or any(
+        kind not in (_PREPROCESSOR, _POSTPROCESSOR) for kind, _ in classified
+    ):
+        raise ValueError(
+            "jit=True requires a sync function "
+            "and layers made only of preprocessors and postprocessors"
+        )
+    try:
+        import numba
+    except ImportError:
+        numba = None
+    # nopython mode can only call functions that are themselves jitted
+    parts = [func] + [middleware._onionizer_func for _, middleware in classified]
+    if numba is None or not all(
+        isinstance(part, numba.core.dispatcher.Dispatcher) for part in parts
+    ):
+        # the generated onion already calls preprocessors and postprocessors
+        # as plain functions,
+        # with the usual handling of None, tuple, dict and bypass values
+        return _generate_sync_onion(func, classified)
+    # nopython functions take positional arguments, and their preprocessors can only
+    # hand back tuples: anything else fails to compile instead of being misread
+    namespace = {"func": func}
+    lines = ["def composed(*args):"]
+    for i, (kind, middleware) in enumerate(classified):
+        namespace[f"layer{i}"] = middleware._onionizer_func
+        if kind == _PREPROCESSOR:
+            lines.append(f"    args = layer{i}(*args)")
+    lines.append("    output = func(*args)")
+    for i, (kind, _) in reversed(list(enumerate(classified))):
+        if kind == _POSTPROCESSOR:
+            lines.append(f"    output = layer{i}(output)")
+    lines.append("    return output")
+    code = compile("\n".join(lines), "<onionizer>", "exec")
+    exec(code, namespace)  # pragma: no mutate
+    composed = numba.njit(namespace.pop("composed"))
+    positional = _positional_arguments(func.py_func)
+
+    def wrapped_func(*args, **kwargs):
+        if kwargs:
+            args = positional(args, kwargs)
+        return composed(*args)
+
+    return wrapped_func
+
+
+def _positional_arguments(func):
+    # the arguments of a call to func, as the positional arguments
+    # that the nopython composition takes
+    signature = inspect.signature(func)
+    for parameter in signature.parameters.values():
+        if parameter.kind in (parameter.KEYWORD_ONLY, parameter.VAR_KEYWORD):
+            raise ValueError(
+                f"jit=True cannot pass the keyword-only parameter {parameter} "
+                f"of {func.__name__} positionally"
+            )
+
+    def positional(args, kwargs):
+        bound = signature.bind(*args, **kwargs)
+        # keyword arguments after a defaulted parameter would be dropped otherwise
+        bound.apply_defaults()
+        return bound.args
 
+    return positional
+
+
+def _leave_the_onion(layers: tuple, output: Any) -> Any:
+    # layers are (coroutine, False) or (postprocessor function, True) pairs,
+    # innermost first
+    for layer, is_postprocessor in layers:
+        if is_postprocessor:
+            output = layer(output)
+            continue
+        try:
+            layer.send(output)
+        except StopIteration as e:
+            output = e.value
+        else:
+            raise _not_exhausted()
+    return output
+
+
+def _invalid_onion(func, middleware):
+    # the error is built once, but raised when the onion is called, as it used to be
+    message = (
+        f"Middleware {middleware} is neither a callable nor a context manager "
+        f"(it needs both __enter__ and __exit__)"
+    )
+    if not asyncio.iscoroutinefunction(func):
+
+        def wrapped_func(*args, **kwargs):
+            raise TypeError(message)
 
         return wrapped_func
 
-    else:
-        @functools.wraps(func)  # pragma: no mutate
+    async def wrapped_func(*args, **kwargs):
+        raise TypeError(message)
+
+    return wrapped_func
+
+
+def _not_a_coroutine(middleware) -> TypeError:
+    return TypeError(
+        f"Middleware {middleware} is not a coroutine. "
+        f"Did you forget to use a yield statement?"
+    )
+
+
+def _not_exhausted() -> RuntimeError:
+    return RuntimeError(
+        "Generator did not exhaust. Your function should yield exactly once."
+    )
+
+
+def _async_onion(func, classified):
+    _is_async = _is_async_generator
+    _HARD_BYPASS = HARD_BYPASS
+    _BYPASS = BYPASS
+    _capture = _capture_message
+    _capture_async = _capture_async_message
+    _unwrap = _unwrap_bypass
+    _refine_ = _refine
+
+    # preprocessor and postprocessor functions are called directly,
+    # without their generator
+    layers = tuple(
+        (
+            kind,
+            middleware._onionizer_func
+            if kind in (_PREPROCESSOR, _POSTPROCESSOR)
+            else middleware,
+            _is_async_generator_function(middleware) if kind == _GENERATOR_FN else None,
+        )
+        for kind, middleware in classified
+    )
+
+    async def enter(args, kwargs, stack):
+        # returns the entered layers and the output if a layer exited early
+        entered = []
+        for kind, layer, is_async in layers:
+            if kind == _CTX_MANAGER:
+                stack.enter_context(layer)
+                continue
+            if kind == _POSTPROCESSOR:
+                # None marks a plain function to call on the way back
+                entered.append((layer, None))
+                continue
+            if kind == _PREPROCESSOR:
+                raw = layer(*args, **kwargs)
+                ended = False
+            else:
+                coroutine = layer(*args, **kwargs)
+                if is_async is None:
+                    # not a plain (async) generator function, e.g. a callable instance
+                    is_async = _is_async(coroutine)
+                if is_async is None:
+                    raise TypeError(
+                        f"Middleware {layer} is not a coroutine. "
+                        f"Did you forget to use a yield statement?"
+                    )
+                if is_async:
+                    raw, ended = await _capture_async(coroutine, None)
+                else:
+                    raw, ended = _capture(coroutine, None)
+            if type(raw) is _HARD_BYPASS:
+                return None, raw.value
+            if type(raw) is _BYPASS:
+                return entered, raw.value
+            if ended:
+                return entered, raw
+            if raw is not None:
+                args, kwargs = _refine_(raw, args, kwargs)
+            if kind == _GENERATOR_FN:
+                entered.append((coroutine, is_async))
+        # just reached the core of the onion
+        return entered, await func(*args, **kwargs)
+
+    async def leave(entered, output):
+        while entered:
+            # popped in reverse order to respect onion model
+            layer, is_async = entered.pop()
+            if is_async is None:
+                raw = layer(output)
+            elif is_async:
+                raw, _ = await _capture_async(layer, output)
+            else:
+                raw, _ = _capture(layer, output)
+            output = _unwrap(raw)
+        return output
+
+    if all(kind == _CTX_MANAGER for kind, _ in classified):
+        # nothing to go back through, the stack of entered layers is not needed
+        context_managers = tuple(middleware for _, middleware in classified)
+
         async def wrapped_func(*args, **kwargs):
             with ExitStack() as stack:
-                arguments = MixedArgs(args, kwargs)
-                coroutines = []
-                a_middleware_exited_with_result = False
-                # programmatic support for context manager, possibly nested !
-                # https://docs.python.org/3/library/contextlib.html#contextlib.ExitStack
-                for middleware in layers:
-                    if hasattr(middleware, "__enter__") and hasattr(middleware, "__exit__"):
-                        stack.enter_context(middleware)
-                        continue
-                    coroutine = arguments.call_function(middleware)
-                    if not isinstance(coroutine, typing.Generator) and not isinstance(coroutine, typing.AsyncGenerator):
-
-                        raise TypeError(
-                            f"Middleware {middleware} is not a coroutine. "
-                            f"Did you forget to use a yield statement?"
-                        )
-                    middleware_output = await async_get_middleware_output(coroutine)
-                    if middleware_output.status == "hard_stop":
-                        return middleware_output.output
-                    if middleware_output.status == "stop":
-                        a_middleware_exited_with_result = True
-                        break
-                    arguments = _refine(middleware_output.output, arguments)
-                    coroutines.append(coroutine)
-                # just reached the core of the onion
-                if a_middleware_exited_with_result is False:
-                    output = await arguments.call_function(func)
-                else:
-                    output = middleware_output.output
-                # now we go back to the surface
-                for coroutine1 in reversed(coroutines):
-                # reversed to respect onion model
-                    middleware_output = await _capture_async_message(coroutine1, output)
-                    output = middleware_output.output
+                for context_manager in context_managers:
+                    stack.enter_context(context_manager)
+                return await func(*args, **kwargs)
+
+        return wrapped_func
+
+    if not any(kind == _CTX_MANAGER for kind, _ in classified):
+
+        async def wrapped_func(*args, **kwargs):
+            entered, output = await enter(args, kwargs, None)
+            if entered is None:
+                # hard bypass, no layer to go back through
                 return output
+            # now we go back to the surface
+            return await leave(entered, output)
+
         return wrapped_func
 
+    async def wrapped_func(*args, **kwargs):
+        with ExitStack() as stack:
+            # programmatic support for context manager, possibly nested !
+            # https://docs.python.org/3/library/contextlib.html#contextlib.ExitStack
+            entered, output = await enter(args, kwargs, stack)
+            if entered is None:
+                return output
+            # now we go back to the surface
+            return await leave(entered, output)
+
+    return wrapped_func
 
 
 def _check_validity(func, layers):
     if not callable(func):
         raise TypeError("func must be callable")
-    if not isinstance(layers, Iterable):
+    if not isinstance(layers, (tuple, list)) and not isinstance(layers, Iterable):
         raise TypeError("layers must be a list of coroutines")
     # if sigcheck:
     #     _inspect_signatures(func, middlewares)
@@ -280,11 +671,20 @@ def _check_validity(func, layers):
 
 
 class ArgsMode(ABC):
+    """
+    Arguments yielded by a middleware.
+    call_function is expected to call func once with the arguments to pass on,
+    onionizer records them to call the next layers and the wrapped function.
+    """
+    __slots__ = ()
+
     def call_function(self, func: Callable[..., Any]):
         raise NotImplementedError
 
 
 class PositionalArgs(ArgsMode):
+    __slots__ = ("args",)
+
     def __init__(self, *args):
         self.args = args
 
@@ -293,6 +693,8 @@ class PositionalArgs(ArgsMode):
 
 
 class KeywordArgs(ArgsMode):
+    __slots__ = ("kwargs",)
+
     def __init__(self, kwargs):
         self.kwargs = kwargs
 
@@ -301,6 +703,8 @@ class KeywordArgs(ArgsMode):
 
 
 class MixedArgs(ArgsMode):
+    __slots__ = ("args", "kwargs")
+
     def __init__(self, args, kwargs):
         self.args = args
         self.kwargs = kwargs
@@ -309,32 +713,101 @@ class MixedArgs(ArgsMode):
         return func(*self.args, **self.kwargs)
 
 
-def _refine(arguments, previous_arguments):
+def _from_sequence(arguments, previous_args, previous_kwargs):
+    return tuple(arguments), {}
+
+
+def _from_mapping(arguments, previous_args, previous_kwargs):
+    return (), arguments
+
+
+def _from_positional_args(arguments, previous_args, previous_kwargs):
+    return arguments.args, {}
+
+
+def _from_keyword_args(arguments, previous_args, previous_kwargs):
+    return (), arguments.kwargs
+
+
+def _from_mixed_args(arguments, previous_args, previous_kwargs):
+    return arguments.args, arguments.kwargs
+
+
+# exact types yielded in practice,
+# so that _refine can skip the slow Sequence/Mapping ABC checks
+_REFINE_FAST: typing.Dict[type, Callable[..., typing.Tuple[tuple, dict]]] = {
+    tuple: _from_sequence,
+    list: _from_sequence,
+    dict: _from_mapping,
+    PositionalArgs: _from_positional_args,
+    KeywordArgs: _from_keyword_args,
+    MixedArgs: _from_mixed_args,
+}
+
+
+def _refine(
+    arguments, previous_args: tuple, previous_kwargs: dict
+) -> typing.Tuple[tuple, dict]:
+    # arguments are carried around as a bare (args, kwargs) pair,
+    # ArgsMode instances are only unpacked at this boundary
     if arguments is None:
-        return previous_arguments
+        return previous_args, previous_kwargs
+    refine = _REFINE_FAST.get(type(arguments))
+    if refine is not None:
+        return refine(arguments, previous_args, previous_kwargs)
     if isinstance(arguments, ArgsMode):
-        return arguments
+        # subclasses may override call_function, the arguments it passes on are recorded
+        return arguments.call_function(_record_arguments)
+    if isinstance(arguments, (tuple, list)):
+        return tuple(arguments), {}
+    if isinstance(arguments, dict):
+        return (), arguments
     if isinstance(arguments, Sequence):
-        return PositionalArgs(*arguments)
+        return tuple(arguments), {}
     if isinstance(arguments, Mapping):
-        return KeywordArgs(arguments)
+        return (), dict(arguments)
     raise TypeError('unrecognized yielded values. Pass a tuple, a dict or an instance of MixedArgs instead')
 
 
+def _record_arguments(*args, **kwargs):
+    return args, kwargs
+
+
 def preprocessor(func):
-    @functools.wraps(func)
     def wrapper(*args, **kwargs) -> OnionGenerator:
         arguments = yield func(*args, **kwargs)
         return arguments
 
+    functools.update_wrapper(wrapper, func)
+    # lets wrap skip the generator and call func directly
+    wrapper._onionizer_func = func
     return wrapper
 
 
 def postprocessor(func):
-    @functools.wraps(func)
     def wrapper(*args, **kwargs) -> OnionGenerator:
         output = yield
         return func(output)
 
+    functools.update_wrapper(wrapper, func)
     # wrapper.ignore_signature_check = True
+    wrapper._onionizer_func = func
     return wrapper
+
+
+# shared by every wrapper that preprocessor/postprocessor make
+_PREPROCESSOR_CODE = preprocessor(lambda: None).__code__
+_POSTPROCESSOR_CODE = postprocessor(lambda: None).__code__
+
+
+# optional compiled driver, see _fast.pyx
+_run_sync: typing.Optional[Callable[..., Any]]
+if os.environ.get("ONIONIZER_PURE_PYTHON"):  # pragma: no cover
+    _run_sync = None
+else:
+    try:
+        from ._fast import run_sync as _compiled_run_sync
+    except ImportError:  # pragma: no cover
+        _run_sync = None
+    else:
+        _run_sync = _compiled_run_sync
@@ -1,5 +1,12 @@
 import asyncio
+import collections
 import contextlib
+import dataclasses
+import functools
+import gc
+import inspect
+import typing
+import weakref
 
 import pytest as pytest
 
@@ -7,7 +14,7 @@ import onionizer
 from onionizer.onionizer import MixedArgs
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def func_that_adds():
     def func(x: int, y: int) -> int:
         return x + y
@@ -76,6 +83,60 @@ def test_kw_only(func_that_adds):
     assert result == 2
 
 
+def test_args_modes(func_that_adds):
+    def middleware1(x: int, y: int):
+        result = yield onionizer.PositionalArgs(x + 1, y)
+        return result
+
+    def middleware2(x: int, y: int):
+        result = yield onionizer.KeywordArgs({"x": x, "y": y + 1})
+        return result
+
+    wrapped_func = onionizer.wrap(func_that_adds, [middleware1, middleware2])
+    result = wrapped_func(x=0, y=0)
+    assert result == 2
+
+
+def test_custom_args_modes(func_that_adds):
+    class Swapped(onionizer.onionizer.ArgsMode):
+        def __init__(self, x, y):
+            self.x, self.y = x, y
+
+        def call_function(self, func):
+            return func(self.y, y=self.x)
+
+    class Doubled(onionizer.PositionalArgs):
+        def call_function(self, func):
+            return func(*(arg * 2 for arg in self.args))
+
+    def middleware1(x: int, y: int):
+        result = yield Swapped(x * 10, y)
+        return result
+
+    def middleware2(x: int, y: int):
+        result = yield Doubled(x, y)
+        return result
+
+    wrapped_func = onionizer.wrap(func_that_adds, [middleware1, middleware2])
+    assert wrapped_func(1, 2) == 24
+
+
+def test_yield_sequence_and_mapping_subclasses(func_that_adds):
+    Point = collections.namedtuple("Point", ["x", "y"])
+
+    def middleware1(x: int, y: int):
+        result = yield Point(x + 1, y)
+        return result
+
+    def middleware2(x: int, y: int):
+        result = yield collections.OrderedDict(x=x, y=y + 1)
+        return result
+
+    wrapped_func = onionizer.wrap(func_that_adds, [middleware1, middleware2])
+    result = wrapped_func(0, 0)
+    assert result == 2
+
+
 def test_preprocessor(func_that_adds):
     @onionizer.preprocessor
     def midd1(x: int, y: int):
@@ -88,6 +149,22 @@ def test_preprocessor(func_that_adds):
     assert result == 2
 
 
+def test_processors_metadata():
+    def double_inputs(x: int, y: int) -> typing.Tuple[int, int]:
+        return x * 2, y * 2
+
+    def negate(val: int) -> int:
+        return -val
+
+    double_inputs.tag = negate.tag = "math"
+    for func in (double_inputs, negate):
+        for processor in (onionizer.preprocessor, onionizer.postprocessor):
+            processed = processor(func)
+            assert typing.get_type_hints(processed) == typing.get_type_hints(func)
+            assert processed.tag == "math"
+            assert processed.__wrapped__ is func
+
+
 def test_postprocessor(func_that_adds):
     @onionizer.postprocessor
     def midd1(val: int):
@@ -100,6 +177,152 @@ def test_postprocessor(func_that_adds):
     assert result == 4
 
 
+def test_pre_and_postprocessors_around_generators(func_that_adds):
+    @onionizer.preprocessor
+    def double_inputs(x: int, y: int):
+        return x * 2, y * 2
+
+    @onionizer.postprocessor
+    def negate(val: int):
+        return -val
+
+    def skip_when_zero(x: int, y: int):
+        if x == 0:
+            return 0
+        result = yield
+        return result + 1
+
+    wrapped_func = onionizer.wrap(
+        func_that_adds, [negate, double_inputs, skip_when_zero, negate]
+    )
+    assert wrapped_func(1, 2) == 5
+    assert wrapped_func(0, 2) == 0
+
+
+def test_decorated_pre_and_postprocessors_are_not_skipped(func_that_adds):
+    calls = []
+
+    def logged(middleware):
+        @functools.wraps(middleware)
+        def wrapper(*args, **kwargs):
+            calls.append(middleware.__name__)
+            return (yield from middleware(*args, **kwargs))
+
+        return wrapper
+
+    @logged
+    @onionizer.preprocessor
+    def double_inputs(x: int, y: int):
+        return x * 2, y * 2
+
+    @logged
+    @onionizer.postprocessor
+    def negate(val: int):
+        return -val
+
+    wrapped_func = onionizer.wrap(func_that_adds, [negate, double_inputs])
+    assert wrapped_func(1, 2) == -6
+    assert calls == ["negate", "double_inputs"]
+
+
+def test_jit_composition_of_pre_and_postprocessors(func_that_adds):
+    @onionizer.preprocessor
+    def double_inputs(x: int, y: int):
+        return x * 2, y * 2
+
+    @onionizer.postprocessor
+    def negate(val: int):
+        return -val
+
+    @onionizer.postprocessor
+    def add_one(val: int):
+        return val + 1
+
+    layers = [negate, double_inputs, add_one]
+    wrapped_func = onionizer.wrap(func_that_adds, layers, jit=True)
+    assert wrapped_func(1, 2) == onionizer.wrap(func_that_adds, layers)(1, 2) == -7
+    assert wrapped_func.__wrapped__ is func_that_adds
+
+
+@pytest.mark.parametrize('jit', [True, False])
+def test_jit_keeps_the_onion_contract(func_that_adds, jit):
+    @onionizer.preprocessor
+    def keep(x: int, y: int):
+        return None
+
+    @onionizer.preprocessor
+    def as_keywords(x: int, y: int):
+        return {"x": x, "y": y * 10}
+
+    @onionizer.preprocessor
+    def bypass_negatives(x: int, y: int):
+        if x < 0:
+            return onionizer.BYPASS(0)
+        if y < 0:
+            return onionizer.HARD_BYPASS(0)
+
+    @onionizer.postprocessor
+    def add_one(val: int):
+        return val + 1
+
+    wrapped_func = onionizer.wrap(
+        func_that_adds, [add_one, keep, as_keywords, bypass_negatives], jit=jit
+    )
+    assert wrapped_func(1, 2) == 22
+    assert wrapped_func(x=1, y=2) == 22
+    assert wrapped_func(-1, 2) == 1
+    assert wrapped_func(1, -2) == 0
+
+
+def test_jit_binds_keyword_arguments_positionally():
+    def func(x, y=2, z=3):
+        return x, y, z
+
+    positional = onionizer.onionizer._positional_arguments(func)
+    assert positional((1,), {"z": 5}) == (1, 2, 5)
+    assert positional((), {"x": 1, "y": 4}) == (1, 4, 3)
+
+    def keyword_only(x, *, y=2):
+        return x + y
+
+    def var_keyword(x, **kwargs):
+        return x
+
+    for func in (keyword_only, var_keyword):
+        with pytest.raises(ValueError):
+            onionizer.onionizer._positional_arguments(func)
+
+
+def test_jit_with_numba():
+    numba = pytest.importorskip("numba")
+
+    @numba.njit
+    def func(x, y=2, z=3):
+        return x + y + z
+
+    @onionizer.preprocessor
+    @numba.njit
+    def double_inputs(x, y, z):
+        return x * 2, y * 2, z * 2
+
+    @onionizer.postprocessor
+    @numba.njit
+    def negate(val):
+        return -val
+
+    wrapped_func = onionizer.wrap(func, [negate, double_inputs], jit=True)
+    assert wrapped_func(1, 2, 3) == -12
+    assert wrapped_func(1, z=5) == -16
+
+
+def test_jit_refuses_generator_layers(func_that_adds):
+    def middleware(x: int, y: int):
+        return (yield)
+
+    with pytest.raises(ValueError):
+        onionizer.wrap(func_that_adds, [middleware], jit=True)
+
+
 def test_postprocessor_with_multiple_values():
     def dummy_func(x, y):
         return x, y
@@ -138,6 +361,86 @@ def test_support_for_context_managers():
     assert another_wrapped_func(x=1, y=1) == 2
 
 
+@pytest.mark.parametrize('managers_count', [1, 16, 17])
+def test_context_managers_exit_after_other_layers(func_that_adds, managers_count):
+    events = []
+
+    @contextlib.contextmanager
+    def tracker(name):
+        events.append(f"enter {name}")
+        yield
+        events.append(f"exit {name}")
+
+    def middleware1(x: int, y: int):
+        events.append("in middleware1")
+        result = yield
+        events.append("out middleware1")
+        return result
+
+    managers = [tracker(i) for i in range(managers_count)]
+    wrapped_func = onionizer.wrap(func_that_adds, [middleware1, *managers])
+    assert wrapped_func(1, 2) == 3
+    assert events == (
+        ["in middleware1"]
+        + [f"enter {i}" for i in range(managers_count)]
+        + ["out middleware1"]
+        + [f"exit {i}" for i in reversed(range(managers_count))]
+    )
+
+
+@pytest.mark.parametrize('managers_count', [1, 17])
+def test_only_context_managers(func_that_adds, managers_count):
+    events = []
+
+    @contextlib.contextmanager
+    def tracker(name):
+        events.append(f"enter {name}")
+        yield
+        events.append(f"exit {name}")
+
+    managers = [tracker(i) for i in range(managers_count)]
+    wrapped_func = onionizer.wrap(func_that_adds, managers)
+    assert wrapped_func(1, 2) == 3
+    assert events == (
+        [f"enter {i}" for i in range(managers_count)]
+        + [f"exit {i}" for i in reversed(range(managers_count))]
+    )
+
+
+@pytest.mark.asyncio
+async def test_only_context_managers_on_asyncfunc():
+    events = []
+
+    @contextlib.contextmanager
+    def tracker(name):
+        events.append(f"enter {name}")
+        yield
+        events.append(f"exit {name}")
+
+    async def func(x, y):
+        events.append("func")
+        return x + y
+
+    wrapped_func = onionizer.wrap(func, [tracker(0), tracker(1)])
+    assert await wrapped_func(1, 2) == 3
+    assert events == ["enter 0", "enter 1", "func", "exit 1", "exit 0"]
+
+
+def test_context_manager_suppressing_exceptions():
+    def func(x, y):
+        return x / y
+
+    def middleware1(x: int, y: int):
+        result = yield
+        return result
+
+    wrapped_func = onionizer.wrap(
+        func, [contextlib.suppress(ZeroDivisionError), middleware1]
+    )
+    assert wrapped_func(1, 0) is None
+    assert wrapped_func(1, 1) == 1
+
+
 def test_support_for_callable_instance(func_that_adds):
 
     class Middleware1:
@@ -205,6 +508,143 @@ def test_as_decorator():
     assert result == 2
 
 
+def test_onions_of_the_same_shape_share_their_code(func_that_adds):
+    def middleware1(x, y):
+        result = yield y, x
+        return result * 2
+
+    def middleware2(x, y):
+        result = yield
+        return result
+
+    wrapped_func1 = onionizer.wrap(
+        func_that_adds, [middleware1, contextlib.nullcontext()]
+    )
+    wrapped_func2 = onionizer.wrap(
+        lambda x, y: x - y, [middleware2, contextlib.nullcontext()]
+    )
+    assert wrapped_func1.__code__ is wrapped_func2.__code__
+    assert wrapped_func1(1, 2) == 6
+    assert wrapped_func2(1, 2) == -1
+
+
+def test_wrapping_twice_gives_the_same_onion(func_that_adds):
+    def middleware1(x, y):
+        result = yield
+        return result
+
+    def middleware2(x, y):
+        result = yield
+        return result
+
+    wrapped_func = onionizer.wrap(func_that_adds, [middleware1, middleware2])
+    assert onionizer.wrap(func_that_adds, (middleware1, middleware2)) is wrapped_func
+    swapped_func = onionizer.wrap(func_that_adds, [middleware2, middleware1])
+    assert swapped_func is not wrapped_func
+    assert onionizer.wrap(func_that_adds, [middleware1]) is not wrapped_func
+    assert wrapped_func(1, 2) == 3
+
+
+def test_onions_are_freed_without_the_cyclic_gc(func_that_adds):
+    def middleware1(x, y):
+        result = yield
+        return result
+
+    @onionizer.preprocessor
+    def swap(x, y):
+        return y, x
+
+    @onionizer.postprocessor
+    def negate(val):
+        return -val
+
+    wrapped_func = onionizer.wrap(
+        func_that_adds, [middleware1, swap, negate, contextlib.nullcontext()]
+    )
+    assert wrapped_func(1, 2) == -3
+    refs = [weakref.ref(obj) for obj in (wrapped_func, swap, negate)]
+    gc.disable()
+    try:
+        del wrapped_func, swap, negate
+        assert [ref() for ref in refs] == [None, None, None]
+    finally:
+        gc.enable()
+
+
+def test_wrapping_again_after_layers_are_freed(func_that_adds):
+    def make_preprocessor(n):
+        @onionizer.preprocessor
+        def add_n(x: int, y: int):
+            return x + n, y
+
+        return add_n
+
+    class Invalid:
+        def __init__(self, n):
+            self.n = n
+
+        def __repr__(self):
+            return f"Invalid({self.n})"
+
+    async def async_func(x: int, y: int):
+        return x + y
+
+    # onions stay alive while the layers they were built from are freed
+    onions = []
+    for n in range(20):
+        layer = make_preprocessor(n)
+        onions.append(onionizer.wrap(func_that_adds, [layer]))
+        assert onions[-1](0, 0) == n
+        onions.append(onionizer.wrap(async_func, [layer]))
+        assert asyncio.run(onions[-1](0, 0)) == n
+        onions.append(onionizer.wrap(func_that_adds, [Invalid(n)]))
+        with pytest.raises(TypeError, match=rf"Invalid\({n}\)"):
+            onions[-1](0, 0)
+        del layer
+        gc.collect()
+
+
+def test_decorators_keep_equal_layers_apart():
+    @dataclasses.dataclass(frozen=True)
+    class Tag:
+        name: str
+        log: list = dataclasses.field(compare=False)
+
+        def __call__(self, x, y):
+            self.log.append(self.name)
+            result = yield
+            return result
+
+    class UnhashableMiddleware:
+        __hash__ = None
+
+        def __call__(self, x, y):
+            result = yield
+            return result
+
+    log_a, log_b = [], []
+    tag_a, tag_b = Tag("t", log_a), Tag("t", log_b)
+    assert tag_a == tag_b
+
+    @onionizer.as_decorator(tag_a)
+    def func_a(x, y):
+        return x + y
+
+    @onionizer.decorate((tag_b,))
+    def func_b(x, y):
+        return x + y
+
+    assert func_a(1, 2) == func_b(1, 2) == 3
+    assert log_a == ["t"]
+    assert log_b == ["t"]
+
+    @onionizer.as_decorator(UnhashableMiddleware())
+    def func(x, y):
+        return x + y
+
+    assert func(x=1, y=2) == 3
+
+
 def test_tooyielding_middleware(func_that_adds):
     def middleware1(*args):
         yield
@@ -235,6 +675,87 @@ def test_incorrects_managers(func_that_adds):
         f2(1, 2)
 
 
+@pytest.mark.asyncio
+async def test_incorrects_managers_on_asyncfunc():
+    class MyManager:
+        def __enter__(self):
+            return self
+
+    async def func(x, y):
+        return x + y
+
+    f = onionizer.wrap(func, layers=[MyManager()])
+    with pytest.raises(TypeError, match="context manager"):
+        await f(1, 2)
+
+
+@pytest.fixture(params=["compiled", "pure python"])
+def sync_driver(request, monkeypatch):
+    # onions without context managers run on the compiled driver when it is built
+    if request.param == "pure python":
+        monkeypatch.setattr(onionizer.onionizer, "_run_sync", None)
+    elif onionizer.onionizer._run_sync is None:
+        pytest.skip("the compiled driver is not built")
+    return request.param
+
+
+def test_wrapped_function_metadata(func_that_adds, sync_driver):
+    def middleware1(x: int, y: int):
+        result = yield
+        return result
+
+    def func(x: int, y: int) -> int:
+        return x + y
+
+    func.route = "/add"
+    wrapped_func = onionizer.wrap(func, [middleware1])
+    assert inspect.isfunction(wrapped_func)
+    assert typing.get_type_hints(wrapped_func) == {"x": int, "y": int, "return": int}
+    assert wrapped_func.route == "/add"
+    wrapped_func = onionizer.wrap(func_that_adds, [middleware1])
+    assert wrapped_func.__name__ == func_that_adds.__name__
+    assert wrapped_func.__qualname__ == func_that_adds.__qualname__
+    assert wrapped_func.__module__ == func_that_adds.__module__
+    assert wrapped_func.__wrapped__ is func_that_adds
+    assert inspect.signature(wrapped_func) == inspect.signature(func_that_adds)
+
+
+def test_wrapped_methods_are_bound():
+    def middleware1(self, x: int):
+        result = yield self, x * 2
+        return result
+
+    class Adder:
+        def __init__(self, y):
+            self.y = y
+
+        @onionizer.as_decorator(middleware1)
+        def add(self, x: int):
+            return x + self.y
+
+    assert Adder(1).add(3) == 7
+    assert Adder.add(Adder(2), 3) == 8
+
+
+def test_no_layers(func_that_adds):
+    wrapped_func = onionizer.wrap(func_that_adds, [])
+    assert wrapped_func is func_that_adds
+    assert onionizer.decorate([])(func_that_adds) is func_that_adds
+
+
+@pytest.mark.parametrize('hardbypass', [True, False])
+def test_single_layer_early_return(func_that_adds, hardbypass):
+    def middleware1(x: int, y: int):
+        if x == 123:
+            return onionizer.HARD_BYPASS(-1) if hardbypass else -1
+        result = yield
+        return result
+
+    wrapped_func = onionizer.wrap(func_that_adds, [middleware1])
+    assert wrapped_func(x=123, y=0) == -1
+    assert wrapped_func(x=1, y=2) == 3
+
+
 def test_incorrect_func():
     with pytest.raises(TypeError) as e:
         onionizer.wrap(1, [])
@@ -309,6 +830,21 @@ def test_early_returns_but_with_yield(func_that_adds, hardbypass, onlyyields):
     assert last_mid.called_out is False
 
 
+@pytest.mark.parametrize('container', [onionizer.BYPASS, None])
+def test_early_return_from_inner_layer(func_that_adds, container):
+    def outer(x: int, y: int):
+        result = yield x + 1, y
+        return result * 10
+
+    def inner(x: int, y: int):
+        if container is None:
+            return -1
+        yield container(-1)
+
+    wrapped_func = onionizer.wrap(func_that_adds, [outer, outer, inner, outer])
+    assert wrapped_func(0, 0) == -100
+
+
 def test_error_for_async_middleware_on_syncfunc(func_that_adds):
     async def middleware1(x: int, y: int):
         await asyncio.sleep(0.1)
@@ -349,6 +885,45 @@ async def test_async_middleware_on_assyncfunc():
     result = await wrapped_func(3)
     assert result == 5
 
+@pytest.mark.asyncio
+async def test_callable_instances_on_asyncfunc():
+    async def func(x: int):
+        return x + 1
+
+    class AsyncMiddleware:
+        async def __call__(self, x: int):
+            res = yield x + 1,
+            yield res * 2
+
+    class SyncMiddleware:
+        def __call__(self, x: int):
+            res = yield x * 3,
+            return res - 1
+
+    wrapped_func = onionizer.wrap(func, [AsyncMiddleware(), SyncMiddleware()])
+    assert await wrapped_func(1) == 12
+
+@pytest.mark.asyncio
+async def test_pre_and_postprocessors_on_asyncfunc():
+    async def func(x: int):
+        await asyncio.sleep(0.1)
+        return x + 1
+
+    @onionizer.preprocessor
+    def double_input(x: int):
+        return x * 2,
+
+    @onionizer.postprocessor
+    def negate(val: int):
+        return -val
+
+    wrapped_func = onionizer.wrap(
+        func, [negate, contextlib.nullcontext(), double_input]
+    )
+    assert await wrapped_func(3) == -7
+    wrapped_func = onionizer.wrap(func, [double_input, negate])
+    assert await wrapped_func(3) == -7
+
 @pytest.mark.asyncio
 async def test_async_middleware_hard_bypass():
     async def func(x:int):
@@ -376,6 +951,27 @@ async def test_async_middleware_normal_bypass():
     result = await wrapped_func(0)
     assert result == -2
 
+@pytest.mark.asyncio
+async def test_async_middleware_ending_without_yield():
+    async def func(x: int):
+        await asyncio.sleep(0.1)
+        return x
+
+    def mid0(x: int):
+        res = yield
+        return (res, "mid0")
+
+    async def middleware1(x: int):
+        if x == 0:
+            return
+        res = yield
+        yield res
+
+    wrapped_func = onionizer.wrap(func, [mid0, middleware1])
+    assert await wrapped_func(0) == (None, "mid0")
+    assert await wrapped_func(1) == (1, "mid0")
+
+
 def test_middleware_raises_error(func_that_adds):
     def middleware1(x: int, y: int):
         raise AttributeError("middleware1 error")
@@ -387,3 +983,14 @@ def test_middleware_raises_error(func_that_adds):
     assert (
             str(e.value) == "middleware1 error"
     )
+
+
+@pytest.mark.asyncio
+async def test_no_layers_on_asyncfunc():
+    async def func(x: int):
+        await asyncio.sleep(0.1)
+        return x + 1
+
+    wrapped_func = onionizer.wrap(func, [])
+    assert wrapped_func is func
+    assert await wrapped_func(1) == 2